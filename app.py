@@ -1,5 +1,15 @@
+import csv
+import hashlib
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import numpy as np
 import streamlit as st
 import pandas as pd
+import pyarrow.csv as pacsv
+import xlsxwriter.workbook as _xlsx_workbook
 from io import BytesIO
 import chardet
 
@@ -19,120 +29,297 @@ uploaded_files = st.file_uploader(
 )
 
 # ---------------- Helper Functions ----------------
-def read_csv_safely(file):
-    raw = file.read()
-    encoding = chardet.detect(raw)["encoding"]
-
-    return pd.read_csv(
-        BytesIO(raw),
-        encoding=encoding,
-        sep=None,
-        engine="python",
-        on_bad_lines="skip"
-    )
+def read_csv_safely(raw):
+    # Sniff encoding from the first 64 KiB only; chardet on the full
+    # file is O(N) and dominates ingest time for large CSVs. This runs
+    # inside the loader's worker thread: chardet holds the GIL, but it
+    # overlaps with other workers' parses, which release it.
+    sample = raw[:65536]
+    encoding = chardet.detect(sample)["encoding"] or "utf-8"
 
-def read_excel_safely(file):
-    filename = file.name.lower()
+    # Sniff the delimiter once up front so we can use pandas' C engine;
+    # sep=None forces the much slower pure-Python parser
+    text_sample = raw[:8192].decode(encoding, errors="replace")
+    try:
+        delimiter = csv.Sniffer().sniff(text_sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        delimiter = ","
 
-    if filename.endswith(".xls"):
-        try:
-            return pd.read_excel(file, engine="xlrd")
-        except Exception:
-            file.seek(0)
-            tables = pd.read_html(file)
-            return tables[0]
-    else:
-        return pd.read_excel(file, engine="openpyxl")
+    # Arrow's CSV reader streams 1 MB blocks through parallel C++
+    # threads and backs string columns with Arrow buffers, which caps
+    # peak memory versus NumPy object-dtype columns
+    try:
+        table = pacsv.read_csv(
+            BytesIO(raw),
+            read_options=pacsv.ReadOptions(
+                encoding=encoding,
+                block_size=1 << 20
+            ),
+            parse_options=pacsv.ParseOptions(
+                delimiter=delimiter,
+                invalid_row_handler=lambda row: "skip"
+            )
+        )
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    except Exception:
+        # Arrow rejects some encodings and ragged layouts; fall back
+        # to pandas' C engine on the same bytes
+        return pd.read_csv(
+            BytesIO(raw),
+            encoding=encoding,
+            sep=delimiter,
+            engine="c",
+            on_bad_lines="skip",
+            low_memory=False
+        )
+
+def read_excel_safely(name, raw):
+    # Some ".xls" exports are really HTML tables in disguise; sniff the
+    # first bytes once instead of paying for a failed Excel parse first
+    head = raw[:512].lower()
+    if b"<html" in head or b"<!doctype html" in head:
+        return pd.read_html(BytesIO(raw))[0]
+
+    # Rust-backed calamine is ~10x faster than openpyxl and far lighter
+    # on memory (no per-cell Python objects); it reads .xls and .xlsx
+    return pd.read_excel(BytesIO(raw), engine="calamine")
 
 def fix_headers_if_needed(df):
-    # If column headers are numeric, promote first valid row as header
-    if all(isinstance(col, int) for col in df.columns):
-        header_row_idx = None
-        for i in range(len(df)):
-            if df.iloc[i].notna().sum() > 0:
-                header_row_idx = i
-                break
-
-        if header_row_idx is not None:
+    # If column headers are numeric, promote first valid row as header.
+    # inferred_type is cached on the Index; the row scan is a single
+    # vectorized reduction instead of a per-row iloc loop.
+    if df.columns.inferred_type == "integer":
+        mask = df.notna().to_numpy().any(axis=1)
+        if mask.any():
+            header_row_idx = int(mask.argmax())
             df.columns = df.iloc[header_row_idx]
             df = df.iloc[header_row_idx + 1:].reset_index(drop=True)
 
-    # Clean column names
-    df.columns = (
-        df.columns
-        .astype(str)
-        .str.strip()
-        .str.replace("\n", " ", regex=False)
+    # Clean column names; at typical column counts a plain comprehension
+    # beats three chained str-accessor passes, each of which allocates a
+    # new Index
+    df.columns = [str(col).strip().replace("\n", " ") for col in df.columns]
+
+    return df
+
+def load_file(name, data):
+    # Caching lives in the session_state digest cache in the main loop;
+    # this stays a pure bytes -> DataFrame function. The readers take the
+    # bytes directly: BytesIO(data) shares the buffer, so there is never
+    # a second full copy of the upload in flight.
+    if name.lower().endswith(".csv"):
+        df = read_csv_safely(data)
+    else:
+        df = read_excel_safely(name, data)
+
+    df = fix_headers_if_needed(df)
+
+    # A categorical with one category stores 1-byte codes instead of an
+    # object column of N identical 8-byte pointers
+    df["source_file"] = pd.Categorical.from_codes(
+        np.zeros(len(df), dtype=np.int8), categories=[name]
     )
 
     return df
 
-def export_to_excel(raw_dfs, combined_df, summary_df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        combined_df.to_excel(writer, index=False, sheet_name="Combined_Data")
-        summary_df.to_excel(writer, index=False, sheet_name="File_Summary")
+def load_one(file):
+    # Runs in a worker thread: parse + normalize only, no Streamlit calls.
+    # Errors are returned, not raised, so one bad file can't sink the batch.
+    try:
+        return file.name, load_file(file.name, file.getvalue()), None
+    except Exception as e:
+        return file.name, None, e
+
+@st.cache_data(show_spinner=False)
+def export_to_parquet(raw_dfs):
+    # Columnar binary output sidesteps xlsx's per-cell XML encoding and
+    # deflate entirely: ~10-50x faster to write and several times
+    # smaller on typical tabular data
+    all_columns = list(dict.fromkeys(
+        col for df in raw_dfs.values() for col in df.columns
+    ))
+    combined = pd.concat(
+        [df.reindex(columns=all_columns) for df in raw_dfs.values()],
+        ignore_index=True
+    )
+
+    buf = BytesIO()
+    combined.to_parquet(
+        buf,
+        engine="pyarrow",
+        compression="zstd",
+        compression_level=3
+    )
+    return buf.getvalue()
 
-        for name, df in raw_dfs.items():
-            sheet_name = name[:31]
-            df.to_excel(writer, index=False, sheet_name=sheet_name)
+class _Deflate1ZipFile(zipfile.ZipFile):
+    # xlsxwriter hardwires zlib's default level 6; level 1 compresses
+    # 3-5x faster for only ~10-15% larger output
+    def __init__(self, *args, **kwargs):
+        kwargs["compresslevel"] = 1
+        super().__init__(*args, **kwargs)
 
-    return output.getvalue()
+# Guards the process-wide ZipFile patch below: Streamlit runs each
+# session's script on its own thread, so concurrent exports with
+# different compression choices would otherwise race on the swap
+_xlsx_zip_lock = threading.Lock()
+
+@st.cache_data(show_spinner=False)
+def export_to_excel(raw_dfs, summary_df, fast_compression=True):
+    # xlsxwriter doesn't expose the deflate level, so swap in the
+    # level-1 ZipFile for the duration of the write; the archive is
+    # only zipped when the writer closes, so the lock must span the
+    # writer's whole lifetime
+    _xlsx_zip_lock.acquire()
+    _xlsx_workbook.ZipFile = (
+        _Deflate1ZipFile if fast_compression else zipfile.ZipFile
+    )
+    try:
+        # Spill to disk past 50 MB instead of holding the workbook in RAM
+        with SpooledTemporaryFile(max_size=50_000_000) as output:
+            # xlsxwriter keeps cells in plain per-row lists rather than
+            # openpyxl's object graph. constant_memory must stay off:
+            # pandas emits body cells column by column, and in that mode
+            # xlsxwriter silently drops writes to already-flushed rows.
+            # Disabling the strings_to_urls/formulas conversions skips a
+            # per-cell regex pass in xlsxwriter's write hot loop.
+            with pd.ExcelWriter(
+                output,
+                engine="xlsxwriter",
+                engine_kwargs={"options": {
+                    "strings_to_urls": False,
+                    "strings_to_formulas": False,
+                }},
+            ) as writer:
+                # Write Combined_Data straight from the per-file frames
+                # with a running startrow offset - no concatenated copy of
+                # all the data is ever materialized. Reindexing to the
+                # union of columns keeps the alignment pd.concat used to
+                # provide, one file at a time.
+                all_columns = list(dict.fromkeys(
+                    col for df in raw_dfs.values() for col in df.columns
+                ))
+
+                row_offset = 0
+                for df in raw_dfs.values():
+                    aligned = df.reindex(columns=all_columns)
+                    if row_offset == 0:
+                        aligned.to_excel(
+                            writer, index=False, sheet_name="Combined_Data"
+                        )
+                        row_offset = len(aligned) + 1
+                    else:
+                        aligned.to_excel(
+                            writer,
+                            index=False,
+                            header=False,
+                            sheet_name="Combined_Data",
+                            startrow=row_offset
+                        )
+                        row_offset += len(aligned)
+
+                summary_df.to_excel(
+                    writer, index=False, sheet_name="File_Summary"
+                )
+
+                for name, df in raw_dfs.items():
+                    sheet_name = name[:31]
+                    df.to_excel(writer, index=False, sheet_name=sheet_name)
+
+            output.seek(0)
+            return output.read()
+    finally:
+        _xlsx_workbook.ZipFile = zipfile.ZipFile
+        _xlsx_zip_lock.release()
 
 # ---------------- Main Logic ----------------
 if uploaded_files:
     raw_dfs = {}
-    combined_list = []
+    row_counts = {}
 
     st.header("🔍 File Previews (50 rows per file)")
 
-    for file in uploaded_files:
-        try:
-            # -------- Read full file --------
-            if file.name.lower().endswith(".csv"):
-                df = read_csv_safely(file)
-            else:
-                df = read_excel_safely(file)
+    # -------- Resolve already-parsed uploads from session_state --------
+    # A 16-byte blake2b digest of the upload is far cheaper to compare
+    # on rerun than re-hashing multi-MB byte strings; parsed frames are
+    # kept in session_state keyed by (name, digest) so reruns skip
+    # parsing entirely. The name is part of the key because two uploads
+    # with identical bytes are still distinct files (and the cached
+    # frame bakes the name into source_file). session_state is only
+    # touched on the main thread.
+    frame_cache = st.session_state.setdefault("_frame_cache", {})
+
+    keyed_files = [
+        ((f.name, hashlib.blake2b(f.getvalue(), digest_size=16).hexdigest()), f)
+        for f in uploaded_files
+    ]
+    pending = [(key, f) for key, f in keyed_files if key not in frame_cache]
+
+    # -------- Read new files in parallel --------
+    # pandas' C engine and calamine release the GIL, so parsing N files
+    # in threads overlaps their decompress/parse pipelines
+    fresh = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(8, len(pending))) as executor:
+            fresh = dict(zip(
+                (key for key, _ in pending),
+                executor.map(load_one, (f for _, f in pending))
+            ))
 
-            # -------- Fix headers if needed --------
-            df = fix_headers_if_needed(df)
+    results = []
+    for key, file in keyed_files:
+        if key in frame_cache:
+            results.append((file.name, frame_cache[key], None))
+        else:
+            name, df, error = fresh[key]
+            if error is None:
+                frame_cache[key] = df
+            results.append((name, df, error))
 
-            # -------- Add metadata --------
-            df["source_file"] = file.name
+    # Evict oldest entries so the cache doesn't grow without bound
+    while len(frame_cache) > 20:
+        frame_cache.pop(next(iter(frame_cache)))
 
-            # -------- Store FULL data --------
-            raw_dfs[file.name] = df
-            combined_list.append(df)
+    for name, df, error in results:
+        if error is not None:
+            st.error(f"❌ Failed to read {name}: {error}")
+            continue
 
-            # -------- Preview ONLY --------
-            with st.expander(f"📄 {file.name}"):
-                st.dataframe(df.head(50), use_container_width=True)
-                st.caption(f"Rows: {df.shape[0]} | Columns: {df.shape[1]}")
+        # -------- Store FULL data --------
+        raw_dfs[name] = df
+        row_counts[name] = df.shape[0]
 
-        except Exception as e:
-            st.error(f"❌ Failed to read {file.name}: {e}")
+        # -------- Preview ONLY --------
+        with st.expander(f"📄 {name}"):
+            st.dataframe(df.head(50), use_container_width=True)
+            st.caption(f"Rows: {df.shape[0]} | Columns: {df.shape[1]}")
 
-    if combined_list:
-        # -------- Append FULL data --------
-        combined_df = pd.concat(combined_list, ignore_index=True)
+    if raw_dfs:
+        # -------- Combined preview (heads only, no full concat) --------
+        # Built once per run; the per-file head copies are released as
+        # soon as the concat returns
+        preview_df = pd.concat(
+            [df.head(100) for df in raw_dfs.values()],
+            ignore_index=True
+        ).head(100)
+
+        total_rows = sum(row_counts.values())
 
         # -------- Summary --------
-        summary_df = (
-            combined_df.groupby("source_file")
-            .size()
-            .reset_index(name="Row_Count")
-        )
+        # Row counts were recorded at ingest time; no need to scan a
+        # concatenated frame with groupby
+        summary_df = pd.DataFrame({
+            "source_file": list(row_counts),
+            "Row_Count": list(row_counts.values())
+        })
 
         st.header("📊 Combined Preview (first 100 rows only)")
-        st.dataframe(combined_df.head(100), use_container_width=True)
+        st.dataframe(preview_df, use_container_width=True)
         st.caption(
-            f"Total Rows: {combined_df.shape[0]} | "
-            f"Total Columns: {combined_df.shape[1]}"
+            f"Total Rows: {total_rows} | "
+            f"Total Columns: {preview_df.shape[1]}"
         )
 
-        # -------- Download FULL data --------
-        excel_data = export_to_excel(raw_dfs, combined_df, summary_df)
-
         st.subheader("💾 Save As")
 
         custom_filename = st.text_input(
@@ -143,11 +330,34 @@ if uploaded_files:
         if not custom_filename.lower().endswith(".xlsx"):
             custom_filename += ".xlsx"
 
+        fast_compression = st.radio(
+            "Excel compression",
+            ["Faster (slightly larger file)", "Smaller (slower)"],
+            horizontal=True
+        ).startswith("Faster")
+
+        # -------- Download FULL data --------
+        # Build the workbook only on demand - computing it unconditionally
+        # re-ran the whole export on every rerun, i.e. on each keystroke
+        # in the filename box. With the export cached, repeated clicks on
+        # unchanged data are free.
+        if st.button("🛠️ Prepare Excel download"):
+            excel_data = export_to_excel(raw_dfs, summary_df, fast_compression)
+
+            st.download_button(
+                label="⬇️ Download Combined Excel (FULL DATA)",
+                data=excel_data,
+                file_name=custom_filename,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+
         st.download_button(
-            label="⬇️ Download Combined Excel (FULL DATA)",
-            data=excel_data,
-            file_name=custom_filename,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            label="⬇️ Download Combined Parquet (fastest)",
+            data=export_to_parquet(raw_dfs),
+            # The suffix check above guarantees the last 5 characters are
+            # ".xlsx" in some casing, which removesuffix would miss
+            file_name=custom_filename[:-5] + ".parquet",
+            mime="application/octet-stream"
         )
 
 else: